@@ -1,13 +1,30 @@
 import os
-import feedparser
+import sys
+import functools
+import math
+import bisect
+import hashlib
 import smtplib
 import json
 import re
+import html
+from html.entities import name2codepoint
 import time
-import google.generativeai as genai
+import io
+import asyncio
+from lxml import etree
+import aiohttp
 from email.mime.text import MIMEText
 from email.header import Header
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from string import Template
+
+try:
+    import orjson  # 可选加速: 解析 Gemini 输出中的大段中文比标准库快
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
 
 # ================= 🔴 配置区域 (Community Edition) =================
 
@@ -18,12 +35,31 @@ SENDER_PASSWORD = os.environ.get("SENDER_PASSWORD", "")
 
 # 2. 隐私收件人 (可选：从 Secrets 读取，防止在 config.json 中暴露)
 ENV_RECEIVER = os.environ.get("RECEIVER_EMAIL", "") 
+_RECEIVER_SPLIT_RE = re.compile(r'[,\s]+')  # 逗号、空格、换行分隔均可
 
 # 3. SMTP 服务器配置
 SMTP_SERVER = "smtp.gmail.com"
 SMTP_PORT = 465  # SSL 端口
-
-# 4. 环境判断
+BEIJING_TZ = timezone(timedelta(hours=8))  # 邮件标题与正文日期统一使用北京时间
+
+# 4. RSS 抓取配置
+MAX_ITEMS_PER_SOURCE = 10
+FETCH_TIMEOUT = 10  # 单个源的网络超时 (秒)，防止慢源拖住整轮抓取
+FEED_HEADERS = {"User-Agent": "Mozilla/5.0 (compatible; DailyNewsBriefing/1.0)"}
+
+# 5. 缓存配置 (GitHub Actions 中由 actions/cache 在多次运行间保留)
+CACHE_DIR = ".cache"
+GEMINI_CACHE_DIR = os.path.join(CACHE_DIR, "gemini")
+GEMINI_CACHE_TTL = 6 * 3600  # AI 分析缓存有效期 (秒)
+NO_CACHE = os.environ.get("NO_CACHE") == "1"
+FEED_CACHE_PATH = os.path.join(CACHE_DIR, "feeds.json")  # url -> {etag, modified, entries}
+SNAPSHOT_PATH = os.path.join(CACHE_DIR, "last_snapshot.json")
+SNAPSHOT_TTL = 6 * 3600  # 新闻快照相同且在此时间内，视为同一次运行的重试 (秒)
+
+# 6. 运行模式: --dry-run 只抓取并渲染邮件，不调用 Gemini、不发送 SMTP (用于 CI 冒烟测试)
+DRY_RUN = "--dry-run" in sys.argv
+
+# 7. 环境判断
 if not os.environ.get("GITHUB_ACTIONS"):
     print("🏠 本地运行模式")
 else:
@@ -31,13 +67,15 @@ else:
 
 # ================= 🛠️ 初始化逻辑 =================
 
-# 初始化 Gemini
-if not GEMINI_API_KEY:
-    print("❌ 错误: 未找到 GEMINI_API_KEY 环境变量")
-    exit(1)
+GEMINI_MODEL = 'gemini-2.5-flash'
+GEMINI_TIMEOUT = 60  # 单次生成的最长等待时间 (秒)
 
-genai.configure(api_key=GEMINI_API_KEY)
-model = genai.GenerativeModel('gemini-2.5-flash')
+@functools.cache
+def _get_model():
+    """首次需要分析时才导入并初始化 Gemini SDK，import 本模块与 --dry-run 都不会加载它"""
+    import google.generativeai as genai
+    genai.configure(api_key=GEMINI_API_KEY)
+    return genai.GenerativeModel(GEMINI_MODEL)
 
 def load_config():
     """从本地 JSON 文件读取配置"""
@@ -48,84 +86,280 @@ def load_config():
         
     try:
         with open(config_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
+            return _json_loads(f.read())
     except Exception as e:
         print(f"❌ 读取 config.json 失败: {e}")
         return None
 
 # ================= 🧠 核心业务逻辑 =================
 
+_TAG_RE = re.compile(r'<[^>]+>')
+SUMMARY_MAX_LEN = 250
+
+def _clean_summary(summary):
+    """去掉 HTML 标签与实体、压缩空白后截断 (摘要越短，Gemini 输入 token 越少)"""
+    if '<' in summary: summary = _TAG_RE.sub(' ', summary)
+    if '&' in summary: summary = html.unescape(summary)
+    summary = " ".join(summary.split())
+    return summary if len(summary) <= SUMMARY_MAX_LEN else summary[:SUMMARY_MAX_LEN]
+
 class NewsDatabase:
-    """内存新闻库 (仅本次运行有效)"""
+    """内存新闻库 (仅本次运行有效)，按字段分列存储，ID 从 1 开始连续分配，第 id - 1 位即对应条目"""
     def __init__(self):
-        self.items = {} 
-        self.current_id = 1
+        self.titles = []
+        self.links = []
+        self.sources = []
+        self.summaries = []
+        self._prompt_cache = ""
+        self._cache_id = -1
 
     def add(self, source_name, entry):
-        title = entry.title.strip()
-        link = entry.link
-        summary = getattr(entry, 'summary', '')[:250]
-        
-        self.items[self.current_id] = {
-            "id": self.current_id,
-            "source": source_name,
-            "title": title,
-            "link": link,
-            "summary": summary
-        }
-        self.current_id += 1
-        return self.current_id - 1
+        self.titles.append(entry.title.strip())
+        self.links.append(entry.link)
+        self.sources.append(source_name)
+        self.summaries.append(_clean_summary(getattr(entry, 'summary', '')))
+        return len(self.titles)
 
     def generate_prompt_text(self):
-        text_block = ""
-        for idx, item in self.items.items():
-            text_block += f"[ID: {idx}] Title: {item['title']} | Source: {item['source']} | Context: {item['summary']}\n"
-        return text_block
+        # 新闻库未变化时直接复用 (如重试分析)
+        if self._cache_id == len(self.titles):
+            return self._prompt_cache
+
+        parts = [
+            f"[ID: {i}] Title: {title} | Source: {source} | Context: {summary}"
+            for i, (title, source, summary) in enumerate(zip(self.titles, self.sources, self.summaries), 1)
+        ]
+        self._prompt_cache = "\n".join(parts) + "\n" if parts else ""
+        self._cache_id = len(self.titles)
+        return self._prompt_cache
+
+    def snapshot_hash(self):
+        """按 ID 顺序对 (title, link) 取哈希，相同哈希意味着 AI 结果中的引用 ID 仍然有效"""
+        payload = json.dumps(list(zip(self.titles, self.links)), ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def has_id(self, idx):
+        return isinstance(idx, int) and 1 <= idx <= len(self.titles)
 
     def get_link_by_id(self, idx):
-        if idx in self.items: return self.items[idx]['link']
-        return "#"
+        return self.links[idx - 1] if self.has_id(idx) else "#"
 
 db = NewsDatabase()
 
+# 条目元素: RSS 2.0 (无命名空间)、RSS 1.0 与 Atom
+_ITEM_TAGS = {"item", "{http://purl.org/rss/1.0/}item", "{http://www.w3.org/2005/Atom}entry"}
+
+def _child_text(elem, ns, *names):
+    """只匹配与条目同一命名空间的子元素，忽略 <media:title>、<atom:link> 等扩展元素"""
+    tags = {ns + name for name in names}
+    for child in elem:
+        if child.tag in tags and child.text:
+            return child.text.strip()
+    return ""
+
+def _entry_link(elem, ns):
+    """RSS 的 <link> 为文本，Atom 的 <link> 为 href 属性；缺失时回退到 <guid>"""
+    for child in elem:
+        if child.tag != ns + "link": continue
+        if child.text and child.text.strip():
+            return child.text.strip()
+        if child.get("href") and child.get("rel", "alternate") == "alternate":
+            return child.get("href")
+    # 无 <link> 时与 feedparser 一致: isPermaLink 不为 false 的 <guid> 即为链接
+    guid = elem.find(ns + "guid")
+    if guid is not None and guid.text and guid.text.strip() and guid.get("isPermaLink", "true").lower() != "false":
+        return guid.text.strip()
+    return ""
+
+_ENTITY_RE = re.compile(rb'&([A-Za-z][A-Za-z0-9]*);')
+_XML_ENTITIES = {b"amp", b"lt", b"gt", b"quot", b"apos"}
+
+def _html_entities_to_numeric(body):
+    """把 XML 未定义的实体换掉: HTML 实体 (&nbsp; 等) 转数字引用，未知实体按原文保留。
+    libxml2 的 recover 模式遇到未定义实体后会连 &amp; 也不再展开，所以不能只靠 recover"""
+    def repl(m):
+        name = m.group(1)
+        if name in _XML_ENTITIES: return m.group(0)
+        cp = name2codepoint.get(name.decode('ascii'))
+        return b"&#%d;" % cp if cp else b"&amp;" + name + b";"
+    return _ENTITY_RE.sub(repl, body) if b'&' in body else body
+
+def _iter_feed_items(stream, limit=MAX_ITEMS_PER_SOURCE):
+    """流式解析 RSS/Atom，只提取 title / link / summary，满 limit 条即停止
+    recover=True: 像 feedparser 一样容忍未定义实体 (如 &nbsp;) 等常见的不规范 XML，而不是整源丢弃"""
+    count = 0
+    for _, elem in etree.iterparse(stream, events=("end",), recover=True):
+        if elem.tag not in _ITEM_TAGS: continue
+
+        ns = elem.tag[:elem.tag.find('}') + 1]  # 无命名空间时为 ""
+        title = _child_text(elem, ns, "title")
+        link = _entry_link(elem, ns)
+        summary = _child_text(elem, ns, "description", "summary")
+        # 释放已处理条目及其之前的兄弟节点，内存占用与 feed 长度无关
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+        if not title or not link: continue
+        yield SimpleNamespace(title=title, link=link, summary=summary)
+        count += 1
+        if count >= limit: break
+
+def _load_feed_cache():
+    if NO_CACHE or not os.path.exists(FEED_CACHE_PATH): return {}
+    try:
+        with open(FEED_CACHE_PATH, 'r', encoding='utf-8') as f:
+            return _json_loads(f.read())
+    except Exception:
+        return {}
+
+def _save_feed_cache(feed_cache):
+    if NO_CACHE: return
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(FEED_CACHE_PATH, 'w', encoding='utf-8') as f:
+            json.dump(feed_cache, f, ensure_ascii=False)
+    except Exception as e:
+        print(f"⚠️ 写入 RSS 缓存失败: {e}")
+
+async def _fetch_feed(session, url, cached):
+    """条件 GET: 带上次的 ETag / Last-Modified，返回 (body, validators)；304 未修改时 body 为 None"""
+    headers = {}
+    if cached.get('entries'):
+        if cached.get('etag'): headers['If-None-Match'] = cached['etag']
+        if cached.get('modified'): headers['If-Modified-Since'] = cached['modified']
+
+    async with session.get(url, headers=headers) as resp:
+        if resp.status == 304:
+            return None, cached
+        resp.raise_for_status()
+        body = await resp.read()
+        return body, {"etag": resp.headers.get("ETag"), "modified": resp.headers.get("Last-Modified")}
+
+async def fetch_all_async(sources_dict, feed_cache):
+    """并发下载所有源的原始 XML，共享连接池 (TLS 会话复用 + DNS 缓存)，失败的源返回异常对象"""
+    connector = aiohttp.TCPConnector(limit=32, ttl_dns_cache=300)
+    timeout = aiohttp.ClientTimeout(total=FETCH_TIMEOUT)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=FEED_HEADERS) as session:
+        tasks = [_fetch_feed(session, url, feed_cache.get(url, {})) for url in sources_dict.values()]
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
 def fetch_all_rss(sources_dict):
-    """抓取模块"""
+    """抓取模块 (asyncio 并发下载，主线程按配置顺序解析入库)"""
     print("📡 正在扫描 RSS 源...")
+    if not sources_dict: return 0
+
     total_fetched = 0
-    MAX_ITEMS_PER_SOURCE = 10 
-    
-    for category, url in sources_dict.items():
-        try:
-            feed = feedparser.parse(url)
-            if not feed.entries:
+    feed_cache = _load_feed_cache()
+    new_cache = {}
+    results = asyncio.run(fetch_all_async(sources_dict, feed_cache))
+
+    for (category, url), result in zip(sources_dict.items(), results):
+        if isinstance(result, BaseException):
+            print(f"   ❌ {category} 失败: {result!r}")
+            if url in feed_cache: new_cache[url] = feed_cache[url]
+            continue
+
+        body, validators = result
+        if body is None:
+            # 304: 源未更新，直接复用上次解析结果
+            entries = [SimpleNamespace(**e) for e in validators['entries']]
+            new_cache[url] = validators
+            print(f"   -> [{category}] +{len(entries)} (未更新，使用缓存)")
+        else:
+            try:
+                entries = list(_iter_feed_items(io.BytesIO(_html_entities_to_numeric(body))))
+            except etree.LxmlError as e:
+                print(f"   ❌ {category} 解析失败: {e}")
+                continue
+
+            if not entries:
                 print(f"   ⚠️ [{category}] 无内容或连接失败")
                 continue
-                
-            entries = feed.entries[:MAX_ITEMS_PER_SOURCE]
+
+            if validators['etag'] or validators['modified']:
+                new_cache[url] = {**validators, "entries": [vars(e) for e in entries]}
             print(f"   -> [{category}] +{len(entries)}")
-            for entry in entries:
-                db.add(category, entry)
-                total_fetched += 1
-        except Exception as e:
-            print(f"   ❌ {category} 失败: {e}")
-            
+
+        for entry in entries:
+            db.add(category, entry)
+            total_fetched += 1
+
+    _save_feed_cache(new_cache)
     print(f"📦 共入库 {total_fetched} 条新闻。")
     return total_fetched
 
-def analyze_market_trends():
-    """AI 分析模块"""
-    news_text_block = db.generate_prompt_text()
-    if not news_text_block: return None
+def _load_cached_analysis(key):
+    """读取未过期的 AI 分析缓存，未命中返回 None"""
+    path = os.path.join(GEMINI_CACHE_DIR, f"{key}.json")
+    if NO_CACHE or not os.path.exists(path): return None
+    if time.time() - os.path.getmtime(path) > GEMINI_CACHE_TTL: return None
 
-    print("\n🧠 正在进行 AI 分析 (宏观 + 情绪)...")
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return _json_loads(f.read())
+    except Exception:
+        return None
 
-    prompt = f"""
+def _prune_cached_analysis():
+    """删除过期的 AI 分析缓存，避免 .cache/gemini 随每次运行 (及 actions/cache) 无限增长"""
+    now = time.time()
+    for entry in os.scandir(GEMINI_CACHE_DIR):
+        name = entry.name
+        # 只清理 <sha256>.json，不动目录下的其他文件
+        if not (name.endswith(".json") and len(name) == 64 + 5 and entry.is_file()): continue
+        try:
+            if now - entry.stat().st_mtime > GEMINI_CACHE_TTL:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
+def _save_cached_analysis(key, result):
+    if NO_CACHE: return
+    try:
+        os.makedirs(GEMINI_CACHE_DIR, exist_ok=True)
+        _prune_cached_analysis()
+        with open(os.path.join(GEMINI_CACHE_DIR, f"{key}.json"), 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False)
+    except Exception as e:
+        print(f"⚠️ 写入 AI 分析缓存失败: {e}")
+
+def load_snapshot(snapshot_hash):
+    """读取上次运行的快照 {hash, ai_result, sent_to (收件人摘要)}，新闻不一致或已过期时返回 None"""
+    if NO_CACHE or not os.path.exists(SNAPSHOT_PATH): return None
+    try:
+        with open(SNAPSHOT_PATH, 'r', encoding='utf-8') as f:
+            snapshot = _json_loads(f.read())
+    except Exception:
+        return None
+
+    if snapshot.get('hash') != snapshot_hash: return None
+    if time.time() - snapshot.get('saved_at', 0) > SNAPSHOT_TTL: return None
+    return snapshot
+
+def receiver_digest(receiver):
+    """快照里只记录收件人的 SHA-256 摘要: .cache 会被 actions/cache 上传，不能暴露隐私收件人地址"""
+    return hashlib.sha256(receiver.encode('utf-8')).hexdigest()
+
+def save_snapshot(snapshot_hash, ai_result, sent_to):
+    if NO_CACHE: return
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(SNAPSHOT_PATH, 'w', encoding='utf-8') as f:
+            json.dump({
+                "hash": snapshot_hash,
+                "saved_at": time.time(),
+                "ai_result": ai_result,
+                "sent_to": sent_to,
+            }, f, ensure_ascii=False)
+    except Exception as e:
+        print(f"⚠️ 写入运行快照失败: {e}")
+
+# 固定指令前缀放在最前、新闻块放在最后: 每次运行只有结尾不同，可命中 Gemini 的隐式前缀缓存。
+# (显式 CachedContent 要求至少 1024 token，这段前缀远不够，故不使用)
+INSTRUCTION_PREFIX = """
     You are a Quantitative Financial Analyst.
-    
-    # RAW NEWS:
-    \"\"\"
-    {news_text_block}
-    \"\"\"
+    You will receive a RAW NEWS block, one story per line in the form `[ID: n] Title: ... | Source: ... | Context: ...`.
 
     # TASKS:
     **Task 1: Market Sentiment Scoring**
@@ -140,130 +374,283 @@ def analyze_market_trends():
     - Select 5 critical stories with `id`, `reason` (Chinese), and `tag`.
 
     # OUTPUT JSON:
-    {{
+    {
         "sentiment_score": 5.5,
         "sentiment_label": "Modestly Bullish",
         "sentiment_reason": "...",
         "analysis_html": "...",
-        "top_picks": [ {{ "id": 1, "reason": "...", "tag": "Bullish" }} ]
-    }}
+        "top_picks": [ { "id": 1, "reason": "...", "tag": "Bullish" } ]
+    }
     """
-    
+
+_JSON_DECODER = json.JSONDecoder()
+
+def _try_decode_json(text):
+    """解析从第一个 '{' 开始的 JSON 对象 (自动忽略 ```json 围栏)，不完整时返回 None"""
+    start = text.find('{')
+    end = text.rfind('}')
+    if start == -1 or end < start: return None
+    # 常见情况: '{' 到最后一个 '}' 恰好是整个对象，走 orjson 快路径
+    try:
+        return _json_loads(text[start:end + 1])
+    except ValueError:
+        pass
+    # JSON 之后还跟着含 '}' 的文字时，切片会失败，改用 raw_decode 只解析第一个完整对象
+    try:
+        return _JSON_DECODER.raw_decode(text, start)[0]
+    except ValueError:
+        return None
+
+def _stream_json_response(gen_model, contents):
+    """流式接收 Gemini 输出，JSON 对象一闭合即返回；超过 GEMINI_TIMEOUT 抛出 TimeoutError"""
+    started = time.monotonic()
+    deadline = started + GEMINI_TIMEOUT
+    response = gen_model.generate_content(contents, stream=True, request_options={"timeout": GEMINI_TIMEOUT})
+
+    buf = []
+    for chunk in response:
+        try:
+            text = chunk.text
+        except ValueError:
+            text = ""  # 无文本的分片 (如结束标记)
+        if text:
+            if not buf:
+                print(f"   ⏱️ 首个分片耗时 {time.monotonic() - started:.1f}s")
+            buf.append(text)
+
+            # 先尝试解析: 刚好在截止时间后到达的最后一个分片不应被丢弃
+            if '}' in text:
+                result = _try_decode_json(''.join(buf))
+                if result is not None: return result
+
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Gemini 响应超过 {GEMINI_TIMEOUT}s")
+
+    result = _try_decode_json(''.join(buf))
+    if result is None:
+        raise ValueError("Gemini 输出中没有完整的 JSON")
+    return result
+
+def analyze_market_trends():
+    """AI 分析模块"""
+    news_text_block = db.generate_prompt_text()
+    if not news_text_block: return None
+
+    print("\n🧠 正在进行 AI 分析 (宏观 + 情绪)...")
+
+    news_prompt = f"""
+    # RAW NEWS:
+    \"\"\"
+    {news_text_block}
+    \"\"\"
+    """
+    prompt = INSTRUCTION_PREFIX + news_prompt
+
+    # 相同 Prompt 在有效期内直接复用结果 (重跑 / 邮件发送失败后重试)
+    cache_key = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+    cached = _load_cached_analysis(cache_key)
+    if cached:
+        print("♻️ 命中 AI 分析缓存，跳过 Gemini 调用")
+        return cached
+
     try:
-        response = model.generate_content(prompt)
-        cleaned_text = re.sub(r"```json|```", "", response.text).strip()
-        return json.loads(cleaned_text)
+        result = _stream_json_response(_get_model(), prompt)
+        _save_cached_analysis(cache_key, result)
+        return result
     except Exception as e:
         print(f"❌ AI 分析失败: {e}")
         return None
 
+_CITATION_RE = re.compile(r'\[(?:ID\s*:?\s*)?(\d+)\]', re.IGNORECASE)
+
+# 对拍开关: CITATION_REGEX=1 时回退到正则实现
+USE_CITATION_REGEX = os.environ.get("CITATION_REGEX") == "1"
+
+def _citation_link(idx):
+    link = db.get_link_by_id(idx)
+    return f' <a href="{link}" style="color:#0056b3; text-decoration:none; font-weight:bold;">[{idx}]</a>'
+
+def _scan_citations(text):
+    """单遍扫描: 匹配 `[N]` / `[ID: N]` (与 _CITATION_RE 等价)，线性时间"""
+    buf = []
+    n = len(text)
+    start = 0  # 尚未输出的原文起点
+    i = text.find('[')
+    while i != -1:
+        j = i + 1
+        if text[j:j + 2].lower() == 'id':
+            j += 2
+            while j < n and text[j].isspace(): j += 1
+            if j < n and text[j] == ':': j += 1
+            while j < n and text[j].isspace(): j += 1
+
+        k = j
+        while k < n and text[k].isdecimal(): k += 1
+
+        if j < k < n and text[k] == ']':
+            buf.append(text[start:i])
+            buf.append(_citation_link(int(text[j:k])))
+            start = k + 1
+            i = text.find('[', start)
+        else:
+            i = text.find('[', i + 1)
+
+    buf.append(text[start:])
+    return ''.join(buf)
+
 def process_citations(text):
-    """引用链接处理 (正则增强版)"""
-    def replace_match(match):
-        idx = int(match.group(1))
-        link = db.get_link_by_id(idx)
-        return f' <a href="{link}" style="color:#0056b3; text-decoration:none; font-weight:bold;">[{idx}]</a>'
-    
-    return re.sub(r'\[(?:ID\s*:?\s*)?(\d+)\]', replace_match, text, flags=re.IGNORECASE)
+    """引用链接处理 (扫描器版)"""
+    if USE_CITATION_REGEX:
+        return _CITATION_RE.sub(lambda m: _citation_link(int(m.group(1))), text)
+    return _scan_citations(text)
+
+# 多段拼接用的分隔符: 不是空白 (\x1e 等会被 `\s` 匹配，导致跨段拼出 `[ID` + `3]`)，也不会出现在 RSS/XML 链接中
+_CITATION_SEP = "\x00"
+
+def process_citations_many(texts):
+    """多段文本一次性处理引用: 拼接后只扫描一遍，再按分隔符拆回，返回与输入等长的列表
+    AI 输出的字段可能是 null 或数字，先统一转成字符串 (None -> "")"""
+    texts = ['' if t is None else str(t) for t in texts]
+    if not texts: return []
+    if any(_CITATION_SEP in t for t in texts):
+        return [process_citations(t) for t in texts]
+    return process_citations(_CITATION_SEP.join(texts)).split(_CITATION_SEP)
+
+# 情绪分颜色: <= -6 | (-6, -2] | (-2, 2) | [2, 6) | >= 6
+# 负区间右端闭合，用 nextafter 把边界挪到下一个浮点数，整体只需一次 bisect_right
+_SENTIMENT_THRESH = [math.nextafter(-6, math.inf), math.nextafter(-2, math.inf), 2, 6]
+_SENTIMENT_COLORS = ["#dc3545", "#ff6b6b", "#6c757d", "#5cdb5c", "#28a745"]
 
 def get_sentiment_color(score):
     try:
         s = float(score)
-        if s >= 6: return "#28a745"
-        if s >= 2: return "#5cdb5c"
-        if s <= -6: return "#dc3545"
-        if s <= -2: return "#ff6b6b"
+    except (TypeError, ValueError):
         return "#6c757d"
-    except: return "#6c757d"
+    if math.isnan(s): return "#6c757d"
+    return _SENTIMENT_COLORS[bisect.bisect_right(_SENTIMENT_THRESH, s)]
 
-def generate_email_html(ai_result):
-    score = ai_result.get('sentiment_score', 0)
-    label = ai_result.get('sentiment_label', 'Neutral')
-    reason = ai_result.get('sentiment_reason', 'No data')
-    color = get_sentiment_color(score)
-    
-    raw_analysis = ai_result.get('analysis_html', '').replace("\n", "<br>")
-    final_analysis = process_citations(raw_analysis)
-    
-    picks_html = ""
-    for pick in ai_result.get('top_picks', []):
-        pid = pick['id']
-        tag = pick.get('tag', 'Neutral')
-        tag_color = "#28a745" if "Bull" in tag else ("#dc3545" if "Bear" in tag else "#6c757d")
-        
-        if pid in db.items:
-            item = db.items[pid]
-            picks_html += f"""
+# 邮件模板在模块加载时解析一次，渲染时只做占位符替换
+_PICK_CARD_TMPL = Template("""
             <div class="pick-card" style="background:#fff; padding:15px; margin-bottom:12px; border-radius:8px; border:1px solid #eee;">
                 <div class="pick-header">
-                    <span style="background:{tag_color}; color:white; padding:2px 6px; border-radius:3px; font-size:10px;">{tag}</span>
-                    <a href="{item['link']}" style="text-decoration:none; color:#000; font-weight:bold;">{item['title']}</a>
+                    <span style="background:${tag_color}; color:white; padding:2px 6px; border-radius:3px; font-size:10px;">${tag}</span>
+                    <a href="${link}" style="text-decoration:none; color:#000; font-weight:bold;">${title}</a>
                 </div>
                 <div style="margin-top:8px; font-size:13px; color:#666;">
-                    <span style="background:#eee; padding:2px 5px;">{item['source']}</span> 💡 {pick['reason']}
+                    <span style="background:#eee; padding:2px 5px;">${source}</span> 💡 ${reason}
                 </div>
             </div>
-            """
-
-    today = (datetime.now() + timedelta(hours=8)).strftime("%Y-%m-%d")
+            """)
 
-    html = f"""
+_EMAIL_TMPL = Template("""
     <html>
-    <head><style>body{{font-family:'Segoe UI',sans-serif;max-width:700px;margin:0 auto;padding:20px;background:#f4f6f9;color:#333;}}</style></head>
+    <head><style>body{font-family:'Segoe UI',sans-serif;max-width:700px;margin:0 auto;padding:20px;background:#f4f6f9;color:#333;}</style></head>
     <body>
-        <div style="background:#fff; padding:20px; border-radius:12px; text-align:center; border-top:5px solid {color}; margin-bottom:25px;">
+        <div style="background:#fff; padding:20px; border-radius:12px; text-align:center; border-top:5px solid ${color}; margin-bottom:25px;">
             <div style="font-size:12px; color:#999;">MARKET SENTIMENT INDEX</div>
-            <div style="font-size:48px; font-weight:bold; color:{color};">{score}</div>
-            <div style="font-size:18px; font-weight:600;">{label}</div>
-            <div style="font-style:italic; color:#777; margin-top:10px;">"{reason}"</div>
+            <div style="font-size:48px; font-weight:bold; color:${color};">${score}</div>
+            <div style="font-size:18px; font-weight:600;">${label}</div>
+            <div style="font-style:italic; color:#777; margin-top:10px;">"${reason}"</div>
         </div>
         <h3>📊 全球市场宏观综述</h3>
-        <div style="background:#fff; padding:25px; border-radius:8px; line-height:1.8;">{final_analysis}</div>
+        <div style="background:#fff; padding:25px; border-radius:8px; line-height:1.8;">${final_analysis}</div>
         <h3>🔥 核心关注</h3>
-        {picks_html}
-        <div style="text-align:center; font-size:12px; color:#aaa; margin-top:40px;">{today} • Community Edition</div>
+        ${picks_html}
+        <div style="text-align:center; font-size:12px; color:#aaa; margin-top:40px;">${today} • Community Edition</div>
     </body></html>
-    """
-    return html
+    """)
+
+def generate_email_html(ai_result, beijing_now):
+    score = ai_result.get('sentiment_score', 0)
+    label = ai_result.get('sentiment_label', 'Neutral')
+    reason = ai_result.get('sentiment_reason', 'No data')
+    color = get_sentiment_color(score)
+    
+    raw_analysis = str(ai_result.get('analysis_html') or '').replace("\n", "<br>")
+    picks = ai_result.get('top_picks', [])
 
-def send_email_to_list(html_body, receivers):
-    """发送邮件给列表中的所有用户"""
+    # 综述、情绪理由与每条精选理由中的引用一次扫描完成
+    final_analysis, reason, *pick_reasons = process_citations_many(
+        [raw_analysis, reason, *(pick.get('reason', '') for pick in picks)]
+    )
+    
+    picks_parts = []
+    for pick, pick_reason in zip(picks, pick_reasons):
+        pid = pick['id']
+        tag = pick.get('tag', 'Neutral')
+        tag_color = "#28a745" if "Bull" in tag else ("#dc3545" if "Bear" in tag else "#6c757d")
+        
+        if db.has_id(pid):
+            picks_parts.append(_PICK_CARD_TMPL.safe_substitute(
+                tag_color=tag_color,
+                tag=tag,
+                link=db.links[pid - 1],
+                title=db.titles[pid - 1],
+                source=db.sources[pid - 1],
+                reason=pick_reason,
+            ))
+
+    today = beijing_now.strftime("%Y-%m-%d")
+
+    return _EMAIL_TMPL.safe_substitute(
+        color=color,
+        score=score,
+        label=label,
+        reason=reason,
+        final_analysis=final_analysis,
+        picks_html="".join(picks_parts),
+        today=today,
+    )
+
+def send_email_to_list(html_body, receivers, beijing_now):
+    """发送邮件给列表中的所有用户，返回发送成功的收件人"""
+    sent = []
     if not receivers: 
         print("📭 收件人列表为空，跳过发送。")
-        return
+        return sent
 
-    beijing_time = datetime.now() + timedelta(hours=8)
-    date_str = beijing_time.strftime('%m-%d')
+    date_str = beijing_now.strftime('%m-%d')
     subject = f"【早报】全球市场洞察 & 每日精选 ({date_str})"
 
     try:
         print("🔌 正在连接 SMTP 服务器...")
         print(f"📧 SENDER_EMAIL: [{SENDER_EMAIL}]")  # ← 添加这行
         print(f"🔑 密码长度: {len(SENDER_PASSWORD)}")  # ← 添加这行
-        server = smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT)
-        server.login(SENDER_EMAIL, SENDER_PASSWORD)
-        
-        for r in receivers:
-            print(f"   -> 发送给: {r} ...")
-            msg = MIMEText(html_body, 'html', 'utf-8')
-            msg['Subject'] = Header(subject, 'utf-8')
-            msg['From'] = SENDER_EMAIL
-            msg['To'] = r
-            server.sendmail(SENDER_EMAIL, r, msg.as_string())
-            time.sleep(2)
-            
-        server.quit()
+        # 正文和标题对所有人相同，只编码一次，逐个收件人仅改写 To
+        msg = MIMEText(html_body, 'html', 'utf-8')
+        msg['Subject'] = Header(subject, 'utf-8')
+        msg['From'] = SENDER_EMAIL
+
+        # 复用同一连接；with 保证异常时也会关闭连接
+        with smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT) as server:
+            server.login(SENDER_EMAIL, SENDER_PASSWORD)
+            for r in receivers:
+                print(f"   -> 发送给: {r} ...")
+                del msg['To']
+                msg['To'] = r
+                server.sendmail(SENDER_EMAIL, r, msg.as_string())
+                sent.append(r)
+
         print("✅ 全部发送完成。")
     except Exception as e:
         print(f"❌ 邮件发送失败: {e}")
+    return sent
 
 # ================= 🚀 主程序入口 =================
 
 if __name__ == "__main__":
+    # 0. 检查 Gemini 凭证 (dry-run 不需要)
+    if not GEMINI_API_KEY and not DRY_RUN:
+        print("❌ 错误: 未找到 GEMINI_API_KEY 环境变量")
+        exit(1)
+
     # 1. 读取本地配置 (JSON)
     config = load_config()
     if not config: exit(1)
 
+    # 本次运行的统一时间戳，避免跨零点时标题与正文日期不一致
+    beijing_now = datetime.now(tz=BEIJING_TZ)
+
     rss_sources = config.get('rss_sources', {})
     
     # 2. 智能合并收件人 (JSON + Environment)
@@ -271,12 +658,12 @@ if __name__ == "__main__":
     
     # 如果环境变量里配置了 RECEIVER_EMAIL (适合 GitHub Secrets 场景)
     if ENV_RECEIVER:
-        secret_receivers = [r.strip() for r in ENV_RECEIVER.split(',') if r.strip()]
+        secret_receivers = [r for r in _RECEIVER_SPLIT_RE.split(ENV_RECEIVER) if r]
         receivers.extend(secret_receivers)
         print(f"🔒 已加载 {len(secret_receivers)} 个隐私收件人")
     
-    # 去重
-    receivers = list(set(receivers))
+    # 去重 (保持原有顺序)
+    receivers = list(dict.fromkeys(receivers))
 
     if not rss_sources:
         print("❌ 配置错误: rss_sources 为空")
@@ -284,14 +671,46 @@ if __name__ == "__main__":
     
     # 3. 执行抓取
     if fetch_all_rss(rss_sources) > 0:
-        # 4. 执行分析
-        res = analyze_market_trends()
+        if DRY_RUN:
+            # 用占位分析结果走一遍引用处理与 HTML 渲染，写到本地供检查
+            preview = {
+                "sentiment_score": 0,
+                "sentiment_label": "Dry Run",
+                "sentiment_reason": "未调用 Gemini",
+                "analysis_html": "Dry run preview [1]",
+                "top_picks": [{"id": 1, "reason": "dry run", "tag": "Neutral"}],
+            }
+            preview_path = os.path.join(CACHE_DIR, "dry_run.html")
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            with open(preview_path, 'w', encoding='utf-8') as f:
+                f.write(generate_email_html(preview, beijing_now))
+            print(f"🧪 Dry run 完成: Prompt {len(db.generate_prompt_text())} 字符，预览已写入 {preview_path}")
+            exit(0)
+
+        # 4. 执行分析 (新闻与上次运行相同时复用结果，只补发给新增收件人)
+        snapshot_hash = db.snapshot_hash()
+        snapshot = load_snapshot(snapshot_hash)
+        if snapshot:
+            sent_to = snapshot.get('sent_to', [])
+            sent_set = set(sent_to)
+            pending = [r for r in receivers if receiver_digest(r) not in sent_set]
+            if not pending:
+                print("♻️ 新闻与上次运行相同，且所有收件人均已发送，跳过。")
+                exit(0)
+            print(f"♻️ 新闻与上次运行相同，复用 AI 分析，仅补发 {len(pending)} 位收件人")
+            res = snapshot.get('ai_result')
+        else:
+            sent_to, pending = [], receivers
+            res = analyze_market_trends()
+
         if res:
             # 5. 执行发送
-            if receivers:
-                html = generate_email_html(res)
-                send_email_to_list(html, receivers)
+            if pending:
+                email_html = generate_email_html(res, beijing_now)
+                sent = send_email_to_list(email_html, pending, beijing_now)
+                sent_to = sent_to + [receiver_digest(r) for r in sent]
             else:
                 print("📭 收件人列表为空 (仅运行分析，不发送)")
+            save_snapshot(snapshot_hash, res, sent_to)
 
 